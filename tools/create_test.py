@@ -1,18 +1,36 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from io import StringIO
+from itertools import chain
 from pathlib import Path
 import argparse
-import csv
 import hashlib
 import json
+import mmap
+import multiprocessing
 import os
+import re
 import subprocess
 import sys
-import tempfile
 import traceback
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 HARNESS_IMPORT_REF = "file#cpu-harness.circ"
 ROM_CONTENTS_REF = "addr/data: 14 32\n0\n"
 HALT_CONSTANT_VAL_REF = "0x4258"
+MAGIC_VALUE_REGEX = re.compile(
+    "|".join(
+        map(re.escape, [HARNESS_IMPORT_REF, ROM_CONTENTS_REF, HALT_CONSTANT_VAL_REF])
+    )
+)
+# Venus --dump prints one 0x-prefixed instruction per line
+HEX_INST_REGEX = re.compile(r"^\s*0x0*([0-9a-fA-F]+)?\s*$")
 TRACE_PATTERN = "%1%,%2%,%5%,%6%,%7%,%8%,%9%,%10%,%pc%,%inst%,%line%\n"
 TRACE_HEADER = [
     "ra",
@@ -27,6 +45,11 @@ TRACE_HEADER = [
     "RequestedInstruction",
     "TimeStep",
 ]
+# Venus runs are short, so JVM startup dominates: skip the optimizing JIT
+# and the multithreaded GC
+VENUS_JVM_ARGS = ["-XX:TieredStopAtLevel=1", "-XX:+UseSerialGC"]
+IO_BUFFER_SIZE = 1 << 20
+HASH_CHUNK_SIZE = 1 << 16
 
 proj_dir_path = Path(__file__).parent.parent
 cpu_harness_circ_path = proj_dir_path / "harnesses" / "cpu-harness.circ"
@@ -34,153 +57,299 @@ run_circ_path = proj_dir_path / "harnesses" / "run.circ"
 logisim_path = proj_dir_path / "tools" / "logisim.jar"
 venus_path = proj_dir_path / "tools" / "venus.jar"
 hashes_path = proj_dir_path / "tools" / ".hashes.json"
+hashes_lock_path = proj_dir_path / "tools" / ".hashes.json.lock"
+venus_dump_cache_path = proj_dir_path / "tools" / ".venus_cache"
+# Leave a couple of cores free for whatever else is running
+default_num_jobs = max(1, (os.cpu_count() or 1) - 2)
 
 
 class TestCreateException(Exception):
     pass
 
 
+# Read once per process, on first use so a broken run.circ is reported per test
+@lru_cache(maxsize=None)
+def load_run_circ_template():
+    if not run_circ_path.is_file():
+        raise TestCreateException(f"Could not find {str(run_circ_path)}")
+    with run_circ_path.open("r") as run_circ_file:
+        run_circ_data = run_circ_file.read()
+    # Python `xml` is insecure, magic values to the rescue!
+    if HARNESS_IMPORT_REF not in run_circ_data:
+        raise TestCreateException(
+            f"Could not find CPU harness import in {str(run_circ_path)}"
+        )
+    if ROM_CONTENTS_REF not in run_circ_data:
+        raise TestCreateException(
+            f"Could not find ROM contents in {str(run_circ_path)}"
+        )
+    if HALT_CONSTANT_VAL_REF not in run_circ_data:
+        raise TestCreateException(f"Could not find halt value in {str(run_circ_path)}")
+    return run_circ_data
+
+
 def get_hash(path):
     if not path.is_file():
         return None
+    h = hashlib.blake2b(digest_size=16)
     with path.open("rb") as f:
-        contents = f.read()
-    contents = contents.replace(b"\r\n", b"\n")
-    return hashlib.md5(contents).hexdigest()
+        size = os.fstat(f.fileno()).st_size
+        # mmap refuses empty files
+        if size == 0:
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            start = 0
+            while start < size:
+                end = min(start + HASH_CHUNK_SIZE, size)
+                # Leave a trailing \r for the next chunk so \r\n is never split
+                if end < size and contents[end - 1] == ord("\r"):
+                    end -= 1
+                h.update(contents[start:end].replace(b"\r\n", b"\n"))
+                start = end
+    return h.hexdigest()
+
+
+def get_hash_entry(path):
+    if not path.is_file():
+        return None
+    stat = path.stat()
+    return {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "hash": get_hash(path),
+    }
 
 
 def check_hash(data, key, path):
     expected = data.get(key)
-    return expected and get_hash(path) == expected
+    # Entries from older versions were bare hashes, treat them as stale
+    if not isinstance(expected, dict) or not path.is_file():
+        return False
+    stat = path.stat()
+    # Same mtime and size means the file wasn't touched, no need to hash it
+    same_mtime = stat.st_mtime_ns == expected.get("mtime_ns")
+    same_size = stat.st_size == expected.get("size")
+    if same_mtime and same_size:
+        return True
+    if get_hash(path) != expected.get("hash"):
+        return False
+    # Only touched (e.g. by a checkout), remember the new stat so the next
+    # run can skip hashing again
+    expected["mtime_ns"] = stat.st_mtime_ns
+    expected["size"] = stat.st_size
+    return True
+
+
+@contextmanager
+def write_atomically(path):
+    # Write to a temp file and os.replace() it in, so readers never see a
+    # partial file. The temp file is removed if anything goes wrong
+    tmp_path = path.with_name(f"{path.name}.tmp.{os.getpid()}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
 
 
-def generate_test_circ(asm_path, test_circ_path, slug, num_cycles):
-    venus_cmd = ["java", "-jar", str(venus_path), str(asm_path), "--dump"]
-    tmp_inst_hex_file = tempfile.NamedTemporaryFile(delete=False)
-    tmp_inst_hex_path = Path(tmp_inst_hex_file.name)
-    with tmp_inst_hex_file:
-        proc = subprocess.Popen(
-            venus_cmd, stdout=tmp_inst_hex_file, encoding="utf-8", errors="ignore"
-        )
-        proc.wait()
-    insts = []
-    with tmp_inst_hex_path.open("r") as inst_hex_file:
-        for line in inst_hex_file:
-            line = line.strip()
-            if not line:
-                continue
-            inst = line.replace("0x", "", 1).lstrip("0")
-            if inst == "":
-                inst = "0"
-            insts.append(inst)
-    try:
-        tmp_inst_hex_path.unlink()
-    except FileNotFoundError:
-        pass
+@contextmanager
+def lock_hashes():
+    with hashes_lock_path.open("a") as hashes_lock_file:
+        # Windows doesn't have fcntl, parallel runs there are on their own
+        if fcntl is not None:
+            fcntl.flock(hashes_lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
 
-    rom_contents = f"addr/data: 14 32\n{' '.join(insts).lower()}\n"
+def load_hashes():
+    hashes = {}
+    if hashes_path.is_file():
+        try:
+            with hashes_path.open("r") as hashes_file:
+                hashes = json.load(hashes_file)
+        except:
+            traceback.print_exc()
+    return hashes
+
+
+def get_venus_cmd(asm_path, *args):
+    return ["java", *VENUS_JVM_ARGS, "-jar", str(venus_path), str(asm_path), *args]
+
+
+def get_dump_cache_path(asm_path):
+    # Keyed on the assembly contents and the Venus build, so only a changed
+    # input or a newly downloaded venus.jar needs a Venus run
+    venus_stat = venus_path.stat()
+    venus_key = f"{venus_stat.st_size}-{venus_stat.st_mtime_ns}"
+    return venus_dump_cache_path / f"{get_hash(asm_path)}-{venus_key}.rom"
+
+
+def dump_rom_contents(asm_path, force=False):
+    dump_cache_path = get_dump_cache_path(asm_path)
+    if not force and dump_cache_path.is_file():
+        with dump_cache_path.open("r", newline="") as dump_cache_file:
+            return dump_cache_file.read()
+
+    venus_cmd = get_venus_cmd(asm_path, "--dump")
+    rom_contents_io = StringIO()
+    rom_contents_write = rom_contents_io.write
+    rom_contents_write("addr/data: 14 32\n")
+    separator = ""
+    # Exiting the block closes the pipe and waits for Venus
+    with subprocess.Popen(
+        venus_cmd,
+        stdout=subprocess.PIPE,
+        bufsize=IO_BUFFER_SIZE,
+        encoding="utf-8",
+        errors="ignore",
+    ) as proc:
+        for line in proc.stdout:
+            match = HEX_INST_REGEX.match(line)
+            if not match:
+                continue
+            rom_contents_write(separator)
+            rom_contents_write((match.group(1) or "0").lower())
+            separator = " "
+    rom_contents_write("\n")
+    rom_contents = rom_contents_io.getvalue()
+    if proc.returncode != 0:
+        return rom_contents
+
+    # Other workers may be writing the same entry, so swap it in atomically
+    venus_dump_cache_path.mkdir(exist_ok=True)
+    with write_atomically(dump_cache_path) as tmp_dump_cache_path:
+        with tmp_dump_cache_path.open("w", newline="") as dump_cache_file:
+            dump_cache_file.write(rom_contents)
+    return rom_contents
+
+
+def generate_test_circ(asm_path, test_circ_path, slug, num_cycles, force=False):
+    rom_contents = dump_rom_contents(asm_path, force=force)
     halt_constant_val = hex(num_cycles)
 
-    # Python `xml` is insecure, magic values to the rescue!
-    with run_circ_path.open("r") as run_circ_file:
-        test_circ_data = run_circ_file.read()
-    if HARNESS_IMPORT_REF not in test_circ_data:
-        raise TestCreateException(
-            f"Could not write CPU harness import for {str(test_circ_path)}"
-        )
-    if ROM_CONTENTS_REF not in test_circ_data:
-        raise TestCreateException(
-            f"Could not write ROM contents for {str(test_circ_path)}"
-        )
-    if HALT_CONSTANT_VAL_REF not in test_circ_data:
-        raise TestCreateException(
-            f"Could not write halt value for {str(test_circ_path)}"
-        )
     # Path.relative_to() only works with direct children
-    test_circ_data = test_circ_data.replace(
-        HARNESS_IMPORT_REF,
-        f"file#{os.path.relpath(cpu_harness_circ_path, test_circ_path.parent)}",
+    harness_import = (
+        f"file#{os.path.relpath(cpu_harness_circ_path, test_circ_path.parent)}"
+    )
+    magic_value_subs = {
+        HARNESS_IMPORT_REF: harness_import,
+        ROM_CONTENTS_REF: rom_contents,
+        HALT_CONSTANT_VAL_REF: halt_constant_val,
+    }
+    # Substitute all magic values in a single scan of the template
+    test_circ_data = MAGIC_VALUE_REGEX.sub(
+        lambda match: magic_value_subs[match.group(0)], load_run_circ_template()
     )
-    test_circ_data = test_circ_data.replace(ROM_CONTENTS_REF, rom_contents)
-    test_circ_data = test_circ_data.replace(HALT_CONSTANT_VAL_REF, halt_constant_val)
-    with test_circ_path.open("w") as test_circ_file:
-        test_circ_file.write(test_circ_data)
+    with write_atomically(test_circ_path) as tmp_test_circ_path:
+        tmp_test_circ_path.write_bytes(test_circ_data.encode("utf-8"))
     print(f"[{slug}] generated test circuit")
 
 
 def generate_output(
-    asm_path, reference_output_path, slug, num_cycles=-1, is_pipelined=False
+    asm_path,
+    reference_output_path,
+    slug,
+    num_cycles=-1,
+    is_pipelined=False,
+    count_cycles=False,
+    strict=False,
 ):
-    venus_cmd = [
-        "java",
-        "-jar",
-        str(venus_path),
-        str(asm_path),
+    venus_cmd = get_venus_cmd(
+        asm_path,
         "--immutableText",
         "--trace",
         "--traceInstFirst",
         "--tracepattern",
         TRACE_PATTERN,
         "--unsetRegisters",
-    ]
+    )
     if num_cycles > -1:
         venus_cmd += ["--traceTotalNumCommands", str(num_cycles + 1)]
     if is_pipelined:
         venus_cmd += ["--traceTwoStage"]
     print(f"venus_cmd: {venus_cmd}", venus_cmd)
-    tmp_trace_file = tempfile.NamedTemporaryFile(delete=False)
-    tmp_trace_path = Path(tmp_trace_file.name)
-
-    with tmp_trace_file:
-        proc = subprocess.Popen(
-            venus_cmd, stdout=tmp_trace_file, encoding="utf-8", errors="ignore"
-        )
-        proc.wait()
-    did_error = proc.returncode != 0
-    # Venus runtime errors have exit code 0
-    if not did_error and tmp_trace_path.exists():
-        with tmp_trace_path.open("r") as trace_file:
-            for trace_line in trace_file:
-                if "[ERROR]" in trace_line:
-                    did_error = True
-                    break
-    if did_error:
-        if tmp_trace_path.exists():
-            print(f"Venus errored (exit code {proc.returncode}), dumping stdout...")
-            print("--- BEGIN stdout ---")
-            with tmp_trace_path.open("r") as trace_file:
-                print(trace_file.read())
-            print("---- END stdout ----")
-        try:
-            tmp_trace_path.unlink()
-        except FileNotFoundError:
-            pass
-        raise TestCreateException(
-            f"Venus errored while generating reference output for {str(asm_path)}"
-        )
-    with tmp_trace_path.open("r") as trace_file:
-        with reference_output_path.open("w", newline="") as reference_output_file:
-            reference_output = csv.writer(reference_output_file, lineterminator="\n")
-            reference_output.writerow(TRACE_HEADER)
+    did_error = False
+    error_output = ""
+    last_trace_line = ""
+    with write_atomically(reference_output_path) as tmp_reference_output_path:
+        # Exiting the block closes the pipe and waits for Venus
+        with subprocess.Popen(
+            venus_cmd,
+            stdout=subprocess.PIPE,
+            bufsize=IO_BUFFER_SIZE,
+            encoding="utf-8",
+            errors="ignore",
+        ) as proc:
+            # Venus already prints CSV rows (see TRACE_PATTERN) of plain
+            # hex/binary values, so they can be copied through as-is
+            with tmp_reference_output_path.open(
+                "w", newline="", buffering=IO_BUFFER_SIZE
+            ) as reference_output_file:
+                reference_output_file.write(",".join(TRACE_HEADER) + "\n")
+                trace_line = proc.stdout.readline()
+                # TRACE_PATTERN has no spaces, so checking the first row is
+                # enough to know whether rows need to be cleaned up
+                sanitize = strict or " " in trace_line
+                trace_lines = chain((trace_line,), proc.stdout) if trace_line else ()
+                for trace_line in trace_lines:
+                    # Venus runtime errors have exit code 0
+                    if "[ERROR]" in trace_line:
+                        did_error = True
+                        error_output = trace_line
+                        break
+                    if sanitize:
+                        trace_line = trace_line.strip().replace(" ", "") + "\n"
+                    reference_output_file.write(trace_line)
+                    if not trace_line.isspace():
+                        last_trace_line = trace_line
+            error_output += proc.stdout.read()
+        if did_error or proc.returncode != 0:
+            # Rows before the error have already been copied into the output
+            with tmp_reference_output_path.open("r", newline="") as trace_file:
+                trace_file.readline()
+                trace_output = trace_file.read()
+            # A single print, so the other trace's output can't end up inside it
+            print(
+                f"Venus errored (exit code {proc.returncode}), dumping stdout...\n"
+                "--- BEGIN stdout ---\n"
+                f"{trace_output}{error_output}\n"
+                "---- END stdout ----"
+            )
+            raise TestCreateException(
+                f"Venus errored while generating reference output for {str(asm_path)}"
+            )
+
+        detected_num_cycles = None
+        if count_cycles:
+            # The last column (%line%) counts up from 0 in binary, one row
+            # per cycle
             detected_num_cycles = 0
-            for trace_line in trace_file:
-                trace_line = trace_line.strip().replace(" ", "")
-                row = trace_line.split(",")
-                reference_output.writerow(row)
-                detected_num_cycles += 1
-    try:
-        tmp_trace_path.unlink()
-    except FileNotFoundError:
-        pass
+            if last_trace_line:
+                try:
+                    detected_num_cycles = int(last_trace_line.rsplit(",", 1)[-1], 2) + 1
+                except ValueError:
+                    raise TestCreateException(
+                        "Could not read cycle count from Venus output for "
+                        f"{str(asm_path)}"
+                    )
 
     output_type = "pipelined" if is_pipelined else "single-cycle"
+    if not count_cycles:
+        print(f"[{slug}] generated {output_type} reference output")
+        return None
     print(
         f"[{slug}] generated {output_type} reference output (cycles: {detected_num_cycles})"
     )
     return detected_num_cycles
 
 
-def create_test(asm_path, hashes, num_cycles=-1, force=False):
+def create_test(
+    asm_path, hashes, num_cycles=-1, force=False, parallel=True, strict=False
+):
     if not asm_path.is_file() or asm_path.suffix != ".s":
         # Extension != filetype. but good enough
         print(f"Error: {str(asm_path)} is not a RISC-V assembly file, skipping")
@@ -209,59 +378,114 @@ def create_test(asm_path, hashes, num_cycles=-1, force=False):
             and check_hash(hash_data, "piperef", reference_output_2stage_path)
         ):
             print(f"[{slug}] no changes, skipping")
+            # check_hash() may have refreshed stats in this copy of the entry
+            hashes[slug] = hash_data
             return
 
     output_dir_path.mkdir(exist_ok=True)
 
     print(f"[{slug}] creating {test_circ_path.name}...")
+    generate_1stage_output = partial(
+        generate_output,
+        asm_path,
+        reference_output_1stage_path,
+        slug,
+        num_cycles=num_cycles,
+        is_pipelined=False,
+        strict=strict,
+    )
+    generate_2stage_output = partial(
+        generate_output,
+        asm_path,
+        reference_output_2stage_path,
+        slug,
+        num_cycles=num_cycles,
+        is_pipelined=True,
+        count_cycles=True,
+        strict=strict,
+    )
     try:
-        generate_output(
-            asm_path,
-            reference_output_1stage_path,
-            slug,
-            num_cycles=num_cycles,
-            is_pipelined=False,
-        )
-        detected_num_cycles = generate_output(
+        if parallel:
+            # Both traces only read the input, so they can run at the same time
+            executor = ThreadPoolExecutor(max_workers=2)
+            try:
+                future_1stage = executor.submit(generate_1stage_output)
+                future_2stage = executor.submit(generate_2stage_output)
+                # Stop at the first failure instead of waiting on the other trace
+                for future in as_completed([future_1stage, future_2stage]):
+                    future.result()
+                detected_num_cycles = future_2stage.result()
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            generate_1stage_output()
+            detected_num_cycles = generate_2stage_output()
+        generate_test_circ(
             asm_path,
-            reference_output_2stage_path,
+            test_circ_path,
             slug,
-            num_cycles=num_cycles,
-            is_pipelined=True,
-        )
-        generate_test_circ(
-            asm_path, test_circ_path, slug, num_cycles=detected_num_cycles
+            num_cycles=detected_num_cycles,
+            force=force,
         )
     except TestCreateException as ex:
         print(f"[{slug}] error: {str(ex)}")
         return
 
-    if is_custom_test:
-        hashes[slug] = {
-            "input": get_hash(asm_path),
-            "circ": get_hash(test_circ_path),
-            "ref": get_hash(reference_output_1stage_path),
-            "piperef": get_hash(reference_output_2stage_path),
-        }
+    if not is_custom_test:
+        return
+    hashes[slug] = {
+        "input": get_hash_entry(asm_path),
+        "circ": get_hash_entry(test_circ_path),
+        "ref": get_hash_entry(reference_output_1stage_path),
+        "piperef": get_hash_entry(reference_output_2stage_path),
+    }
 
 
-def create_tests(asm_paths, num_cycles=-1, force=False):
+def create_tests(
+    asm_paths, num_cycles=-1, force=False, num_jobs=default_num_jobs, strict=False
+):
     asm_paths = sorted(asm_paths)
 
-    hashes = {}
-    if hashes_path.is_file():
-        try:
-            with hashes_path.open("r") as hashes_file:
-                hashes = json.load(hashes_file)
-        except:
-            traceback.print_exc()
-
-    for asm_path in asm_paths:
-        create_test(asm_path, hashes=hashes, num_cycles=num_cycles, force=force)
+    hashes = load_hashes()
+    # Running both traces of a test at once doubles the JVMs per worker, so
+    # only do it when the busy workers leave enough cores for the extra one
+    num_busy_jobs = min(num_jobs, len(asm_paths))
+    parallel = 2 * num_busy_jobs <= (os.cpu_count() or 1)
+
+    # Workers read and update one shared copy of the hashes instead of each
+    # getting their own snapshot
+    with multiprocessing.Manager() as manager:
+        shared_hashes = manager.dict(hashes)
+        # Each test spawns its own Venus processes, so tests can run side by side
+        with ProcessPoolExecutor(max_workers=num_jobs) as executor:
+            futures = [
+                executor.submit(
+                    create_test,
+                    asm_path,
+                    hashes=shared_hashes,
+                    num_cycles=num_cycles,
+                    force=force,
+                    parallel=parallel,
+                    strict=strict,
+                )
+                for asm_path in asm_paths
+            ]
+            for future in as_completed(futures):
+                future.result()
+        updated_hashes = {
+            slug: hash_data
+            for slug, hash_data in shared_hashes.items()
+            if hashes.get(slug) != hash_data
+        }
 
     hashes_path.parent.mkdir(exist_ok=True)
-    with hashes_path.open("w") as hashes_file:
-        json.dump(hashes, hashes_file)
+    with lock_hashes():
+        # Reload in case another run saved its hashes while this one was busy
+        hashes = load_hashes()
+        hashes.update(updated_hashes)
+        with write_atomically(hashes_path) as tmp_hashes_path:
+            with tmp_hashes_path.open("w") as hashes_file:
+                json.dump(hashes, hashes_file)
 
 
 if __name__ == "__main__":
@@ -286,6 +510,19 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of tests to create in parallel",
+        type=int,
+        default=default_num_jobs,
+    )
+    parser.add_argument(
+        "--debug",
+        help="Clean up every line of Venus output, even if it looks clean",
+        action="store_true",
+        default=False,
+    )
     args = parser.parse_args()
 
     input_paths = args.input_path
@@ -293,4 +530,6 @@ if __name__ == "__main__":
         input_paths = (proj_dir_path / "tests" / "integration-custom" / "in").glob(
             "*.s"
         )
-    create_tests(input_paths, args.cycles, args.force)
+    create_tests(
+        input_paths, args.cycles, args.force, max(1, args.jobs), strict=args.debug
+    )